@@ -1,78 +1,208 @@
 import os
+import re
+import tempfile
+import time
 import uuid
-from typing import List, Dict, Optional
+import asyncio
+import contextlib
+import hashlib
+import weakref
+from collections import deque
+from itertools import islice
+from typing import Dict, Optional
+from cachetools import LRUCache
+import redis.asyncio as redis
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.staticfiles import StaticFiles
+from pydantic import BaseModel, ConfigDict
 import google.generativeai as genai
+from google.generativeai import client as genai_client
 from dotenv import load_dotenv
 
+# Prefer orjson for parsing model output and encoding our own JSON (much faster),
+# but keep working with the stdlib json if it isn't installed. Responses are left to
+# FastAPI, which serializes response models straight to JSON bytes via Pydantic.
+try:
+    import orjson
+    json_loads = orjson.loads
+    def json_dumps(obj) -> str:
+        return orjson.dumps(obj).decode()
+except ImportError:
+    import json
+    json_loads = json.loads
+    json_dumps = json.dumps
+
 load_dotenv()
 
-app = FastAPI()
+# The SDK keeps one async client per process whose grpc.aio channel multiplexes every
+# request over a pooled HTTP/2 connection. Create it on the serving loop at startup so
+# the first chat doesn't pay for it, and close the pooled connections on shutdown.
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    if model:
+        genai_client.get_default_generative_async_client()
+    yield
+    # Let pending history writes land before their connections go away
+    if background_tasks:
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+    if model:
+        await genai_client.get_default_generative_async_client().transport.close()
+    if redis_client:
+        await redis_client.aclose()
+
+app = FastAPI(lifespan=lifespan)
+
+# Compress larger JSON replies (interview evaluations run to several KB).
+# Starlette >= 0.46 leaves text/event-stream alone, so /chat/stream still streams.
+app.add_middleware(GZipMiddleware, minimum_size=1024)
 
-# Enable CORS
+# Enable CORS for the frontend origins only (comma-separated FRONTEND_ORIGIN).
+# The defaults cover the app opened on http://localhost:8000 or 127.0.0.1:8000; add a
+# dev server's origin (e.g. http://localhost:5500) to FRONTEND_ORIGIN to use it.
+# FRONTEND_ORIGIN_REGEX is an opt-in extra pattern, off by default.
+# "null" (sandboxed iframes on any site, file: pages) is never allowed, since
+# credentials are allowed too.
+FRONTEND_ORIGINS = [
+    origin.strip()
+    for origin in os.getenv("FRONTEND_ORIGIN", "http://localhost:8000,http://127.0.0.1:8000").split(",")
+    if origin.strip() and origin.strip() != "null"
+]
+FRONTEND_ORIGIN_REGEX = os.getenv("FRONTEND_ORIGIN_REGEX") or None
+if FRONTEND_ORIGIN_REGEX and re.fullmatch(FRONTEND_ORIGIN_REGEX, "null"):
+    print("WARNING: FRONTEND_ORIGIN_REGEX matches the 'null' origin; ignoring it.")
+    FRONTEND_ORIGIN_REGEX = None
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],  # For local development convenience
+    allow_origins=FRONTEND_ORIGINS,
+    allow_origin_regex=FRONTEND_ORIGIN_REGEX,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    max_age=86400,  # Let browsers cache the preflight for a day
 )
 
 # --- Data Models ---
+# Frozen (immutable) models; nothing modifies a request or response after it's built
 class ChatRequest(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     user_message: str
     mode: Optional[str] = "chat" # Default to chat
     session_id: Optional[str] = None
 
 class ChatResponse(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     ai_reply: str
     grammar_correction: Optional[str] = None
     session_id: str
 
-# --- In-memory Storage ---
-# Structure: { session_id: [ {"role": "user", "parts": ["msg"]}, ... ] }
-# We will limit to last 10 turns (20 messages)
-conversations: Dict[str, List[Dict[str, str]]] = {}
+# --- Session Storage ---
+# Structure: { session_id: deque([ {"role": "user", "parts": ["msg"]}, ... ]) }
+# We will limit to last 10 turns (20 messages); the deque drops older ones itself.
+# The LRU cap stops sessions that are never seen again from piling up forever.
+MAX_HISTORY = 20
+conversations = LRUCache(maxsize=int(os.getenv("MAX_SESSIONS", "10000")))
+
+# With several workers each process has its own `conversations`, so a session only
+# survives load-balancing if history lives in Redis (SESSION_BACKEND=redis).
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "memory").lower()
+SESSION_TTL = int(os.getenv("SESSION_TTL", "86400"))
+redis_client = None
+if SESSION_BACKEND == "redis":
+    redis_client = redis.from_url(os.getenv("REDIS_URL", "redis://localhost:6379/0"))
 
 # --- Gemini Configuration ---
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY") or os.getenv("GEMINI_API_KEY")
 model = None
 TARGET_MODEL_NAME = ""
 
+MODEL_CACHE_PATH = os.getenv("MODEL_CACHE_PATH") or os.path.join(os.path.expanduser("~"), ".cache", "ai-speak", "model.json")
+MODEL_CACHE_TTL = int(os.getenv("MODEL_CACHE_TTL", "86400"))
+
+# Priority list for models likely to have better quotas
+PRIORITY_MODELS = [
+    'models/gemma-3-27b-it',
+    'models/gemma-3-12b-it',
+    'models/gemma-3-4b-it',
+    'models/gemini-2.0-flash', # Keeping as fallback
+    'models/gemini-flash-latest'
+]
+
+def discover_model() -> str:
+    priority_models = PRIORITY_MODELS
+    rank = {p: i for i, p in enumerate(priority_models)}
+    
+    # list_models() fetches pages lazily, so stop as soon as the top priority model
+    # shows up instead of enumerating every model the key can see
+    best_rank = len(priority_models)
+    first_model = gemma_model = None
+    scanned = 0
+    for m in genai.list_models():
+        scanned += 1
+        name = m.name
+        first_model = first_model or name
+        if name in rank:
+            best_rank = min(best_rank, rank[name])
+            if best_rank == 0:
+                break
+        elif not gemma_model and 'gemma' in name and '-it' in name:
+            # Fallback: any gemma model
+            gemma_model = name
+    print(f"Scanned {scanned} available models")
+    
+    if best_rank < len(priority_models):
+        return priority_models[best_rank]
+    return gemma_model or first_model or 'models/gemini-1.5-flash'
+
+def resolve_model() -> str:
+    # A recent cached choice lets restarts skip the list_models() round trip. It only
+    # counts if it was made with the same API key and priority list as now.
+    key_fingerprint = hashlib.blake2b(GOOGLE_API_KEY.encode(), digest_size=16).hexdigest()
+    try:
+        if time.time() - os.path.getmtime(MODEL_CACHE_PATH) < MODEL_CACHE_TTL:
+            with open(MODEL_CACHE_PATH, "rb") as f:
+                cached = json_loads(f.read())
+            if not isinstance(cached, dict):
+                cached = {}
+            target_model = cached.get("model")
+            if not isinstance(target_model, str) or not target_model:
+                print("Ignoring model cache: unexpected contents")
+            elif cached.get("key") != key_fingerprint or cached.get("priority") != PRIORITY_MODELS:
+                print("Ignoring model cache: made with a different API key or model priority list")
+            else:
+                print(f"Using cached model selection from {MODEL_CACHE_PATH}")
+                return target_model
+    except (OSError, ValueError) as e:
+        if not isinstance(e, FileNotFoundError):
+            print(f"Ignoring model cache: {e}")
+
+    target_model = discover_model()
+    try:
+        # Write to a temp file and rename it into place, so workers booting together
+        # never read a half-written cache
+        cache_dir = os.path.dirname(MODEL_CACHE_PATH)
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(json_dumps({"model": target_model, "key": key_fingerprint, "priority": PRIORITY_MODELS}))
+            os.replace(tmp_path, MODEL_CACHE_PATH)
+        except OSError:
+            os.unlink(tmp_path)
+            raise
+    except OSError as e:
+        print(f"Could not cache model selection: {e}")
+    return target_model
+
 if GOOGLE_API_KEY:
     print(f"GOOGLE_API_KEY found in environment (starting with {GOOGLE_API_KEY[:4]}...)")
     try:
         genai.configure(api_key=GOOGLE_API_KEY)
-        # listing available models to debug
-        available_models = [m.name for m in genai.list_models()]
-        print(f"Available models count: {len(available_models)}")
-        
-        # Priority list for models likely to have better quotas
-        priority_models = [
-            'models/gemma-3-27b-it',
-            'models/gemma-3-12b-it',
-            'models/gemma-3-4b-it',
-            'models/gemini-2.0-flash', # Keeping as fallback
-            'models/gemini-flash-latest'
-        ]
-        
-        target_model = None
-        for p in priority_models:
-            if p in available_models:
-                target_model = p
-                break
-        
-        if not target_model:
-             # Fallback: search for any gemma model first
-             for m in available_models:
-                 if 'gemma' in m and '-it' in m:
-                     target_model = m
-                     break
-        
-        if not target_model:
-            target_model = available_models[0] if available_models else 'models/gemini-1.5-flash'
+        target_model = resolve_model()
         
         print(f"Selected model: {target_model}")
         TARGET_MODEL_NAME = target_model
@@ -81,7 +211,6 @@ if GOOGLE_API_KEY:
     except Exception as e:
         print(f"Error configuring Gemini API: {e}")
 else:
-    import os
     print(f"DEBUG: Available env keys: {list(os.environ.keys())}")
     print("WARNING: GOOGLE_API_KEY not found. Running in MOCK mode.")
 
@@ -137,82 +266,244 @@ Constraints:
 - Do not mention you are an AI. Stay in character as the interviewer.
 """
 
-def manage_history(session_id: str, new_message: dict):
+JSON_REMINDER = "Respond ONLY in valid JSON format."
+
+# The opening exchange for each mode never changes, so build it once at import
+PROMPT_PREFIX = {
+    name: (
+        {"role": "user", "parts": [prompt]},
+        {"role": "model", "parts": ["Understood."]},
+    )
+    for name, prompt in (("chat", CHAT_PROMPT), ("interview", INTERVIEW_PROMPT))
+}
+
+# Use JSON mode if possible (Gemini), otherwise standard (Gemma)
+JSON_MODE = 'gemini' in TARGET_MODEL_NAME.lower()
+GEN_CONFIG = {"response_mime_type": "application/json"} if JSON_MODE else {}
+
+# Optionally cap concurrent upstream calls (GEMINI_MAX_CONCURRENCY) so a burst of users
+# queues here instead of turning into rate-limit errors. Unset or 0 means no cap.
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "0"))
+gemini_slots = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY) if GEMINI_MAX_CONCURRENCY > 0 else contextlib.nullcontext()
+
+# Identical prompts arriving while one is already waiting on Gemini (e.g. everyone
+# opening an interview) share that single upstream call instead of each firing their own.
+# The call runs as its own task, so no single caller disconnecting cancels it for the rest.
+inflight: Dict[bytes, asyncio.Task] = {}
+
+async def call_model(contents: list, gen_config: dict):
+    async with gemini_slots:
+        return await model.generate_content_async(contents, generation_config=gen_config)
+
+async def generate_reply(contents: list, gen_config: dict):
+    key = hashlib.blake2b(json_dumps([contents, gen_config]).encode(), digest_size=16).digest()
+    task = inflight.get(key)
+    if task is None:
+        task = inflight[key] = asyncio.ensure_future(call_model(contents, gen_config))
+
+        def forget(done: asyncio.Task):
+            if inflight.get(key) is done:
+                del inflight[key]
+            if not done.cancelled():
+                done.exception()  # Don't warn when every caller has gone away
+
+        task.add_done_callback(forget)
+    return await asyncio.shield(task)
+
+async def stream_reply(contents: list, gen_config: dict):
+    # Hold the slot until the whole stream has been read
+    async with gemini_slots:
+        response = await model.generate_content_async(contents, generation_config=gen_config, stream=True)
+        async for chunk in response:
+            yield chunk.text
+
+def build_contents(history: list, mode: str, user_text: str) -> list:
+    # Send the stored history as chat turns (the same shape ChatSession uses)
+    # instead of flattening it into one transcript string every request.
+    # Gemma has no system instruction, so the prompt opens the conversation.
+    # If trimming left a model reply as the oldest turn, skip it so
+    # turns keep alternating after the opening exchange
+    start = 1 if history and history[0]["role"] == "model" else 0
+    return [
+        *PROMPT_PREFIX["interview" if mode == "interview" else "chat"],
+        *islice(history, start, None),
+        {"role": "user", "parts": [user_text, JSON_REMINDER]},
+    ]
+
+# Gemma may wrap its JSON in ``` fences (possibly unterminated); Gemini's JSON mode never does
+FENCE_RE = re.compile(r"```(?:json)?\s*(.*?)(?:```|$)", re.DOTALL)
+
+def parse_reply(text: str) -> dict:
+    if not JSON_MODE:
+        match = FENCE_RE.search(text)
+        if match:
+            text = match.group(1)
+    return json_loads(text)
+
+async def get_history(session_id: str) -> list:
+    if redis_client:
+        return [json_loads(m) for m in await redis_client.lrange(f"session:{session_id}", 0, -1)]
+    return list(conversations.get(session_id, ()))
+
+# One lock per session keeps its history reads and writes in order within this worker;
+# entries vanish once unused
+session_locks = weakref.WeakValueDictionary()
+# Keep references to fire-and-forget tasks so they aren't garbage collected mid-flight
+background_tasks = set()
+
+def session_lock(session_id: str) -> asyncio.Lock:
+    lock = session_locks.get(session_id)
+    if lock is None:
+        lock = session_locks[session_id] = asyncio.Lock()
+    return lock
+
+async def append_history(session_id: str, new_message: dict):
+    # Callers hold the session lock
+    if redis_client:
+        key = f"session:{session_id}"
+        pipe = redis_client.pipeline()
+        pipe.rpush(key, json_dumps(new_message))
+        pipe.ltrim(key, -MAX_HISTORY, -1)
+        pipe.expire(key, SESSION_TTL)
+        await pipe.execute()
+        return
+
     if session_id not in conversations:
-        conversations[session_id] = []
+        conversations[session_id] = deque(maxlen=MAX_HISTORY)
     
     conversations[session_id].append(new_message)
-    
-    # Keep only last 20 messages (10 turns)
-    if len(conversations[session_id]) > 20:
-        conversations[session_id] = conversations[session_id][-20:]
+
+async def manage_history(session_id: str, new_message: dict):
+    async with session_lock(session_id):
+        await append_history(session_id, new_message)
+
+async def start_turn(session_id: str, user_text: str) -> list:
+    # Read the earlier turns and store this message in one locked step
+    async with session_lock(session_id):
+        history = await get_history(session_id)
+        await append_history(session_id, {"role": "user", "parts": [user_text]})
+    return history
+
+async def remember_reply(session_id: str, ai_reply: str):
+    # Awaited before responding, so the next turn sees this reply whichever worker
+    # (with SESSION_BACKEND=redis) ends up serving it
+    await manage_history(session_id, {"role": "model", "parts": [ai_reply]})
+
+def remember_reply_later(session_id: str, ai_reply: str):
+    # For when the request is being torn down and can't await anything any more.
+    # Best effort: nothing orders this write against a follow-up on another worker.
+    task = asyncio.create_task(manage_history(session_id, {"role": "model", "parts": [ai_reply]}))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
 
 @app.post("/chat", response_model=ChatResponse)
 async def chat_endpoint(request: ChatRequest):
     session_id = request.session_id or str(uuid.uuid4())
     user_text = request.user_message
     mode = request.mode or "chat"
+
+    if model is None:
+        # Mock Response: no model reads the history, so skip it and the response model
+        return JSONResponse({
+            "ai_reply": f"[{mode.upper()} MODE] I heard you say: '{user_text}'. (MockAI Mode)",
+            "grammar_correction": "Mock feedback: Good effort!" if mode == "interview" else None,
+            "session_id": session_id,
+        })
     
-    # Add user message to history
-    manage_history(session_id, {"role": "user", "parts": [user_text]})
+    # Earlier turns, then add user message to history
+    history = await start_turn(session_id, user_text)
 
-    ai_reply = ""
-    grammar_correction = None
+    try:
+        contents = build_contents(history, mode, user_text)
+        response = await generate_reply(contents, GEN_CONFIG)
+        
+        data = parse_reply(response.text)
+        ai_reply = data.get("ai_reply", "I'm sorry, I didn't catch that.")
+        grammar_correction = data.get("grammar_correction")
 
-    if model:
+    except Exception as e:
+        print(f"Error calling AI: {e}")
+        ai_reply = f"I'm having trouble connecting to my brain right now. Error details: {str(e)}"
+        grammar_correction = None
+
+    # Update history with AI response
+    await remember_reply(session_id, ai_reply)
+
+    return ChatResponse(
+        ai_reply=ai_reply,
+        grammar_correction=grammar_correction,
+        session_id=session_id
+    )
+
+# Same as /chat, but streams the model output as Server-Sent Events: each `data:`
+# frame carries a `delta` of raw model text, the final `event: done` frame carries
+# the parsed ChatResponse fields.
+@app.post("/chat/stream")
+async def chat_stream_endpoint(request: ChatRequest):
+    session_id = request.session_id or str(uuid.uuid4())
+    user_text = request.user_message
+    mode = request.mode or "chat"
+
+    # Ask proxies (nginx in particular) not to buffer the event stream
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+    if model is None:
+        # Mock Response: like /chat, no model reads the history, so skip it
+        ai_reply = f"[{mode.upper()} MODE] I heard you say: '{user_text}'. (MockAI Mode)"
+        done = {
+            "ai_reply": ai_reply,
+            "grammar_correction": "Mock feedback: Good effort!" if mode == "interview" else None,
+            "session_id": session_id,
+        }
+        frames = [f"data: {json_dumps({'delta': ai_reply})}\n\n", f"event: done\ndata: {json_dumps(done)}\n\n"]
+        return StreamingResponse(iter(frames), media_type="text/event-stream", headers=headers)
+
+    history = await start_turn(session_id, user_text)
+
+    async def events():
+        text = []
         try:
-            # Select prompt based on mode
-            system_prompt = INTERVIEW_PROMPT if mode == "interview" else CHAT_PROMPT
-            
-            context_str = "\n".join([f"{msg['role'].upper()}: {msg['parts'][0]}" for msg in conversations[session_id]])
-            full_prompt = f"{system_prompt}\n\nConversation History:\n{context_str}\n\nRespond ONLY in valid JSON format."
-            
-            # Use JSON mode if possible (Gemini), otherwise standard (Gemma)
-            gen_config = {}
-            if 'gemini' in TARGET_MODEL_NAME.lower():
-                gen_config["response_mime_type"] = "application/json"
-            
-            response = model.generate_content(full_prompt, generation_config=gen_config)
-            
-            # Robust JSON extraction
-            import json
-            text = response.text.strip()
-            
-            # For models like Gemma that might wrap JSON in backticks
-            if "```json" in text:
-                text = text.split("```json")[-1].split("```")[0].strip()
-            elif "```" in text:
-                text = text.split("```")[-1].split("```")[0].strip()
-            
-            data = json.loads(text)
+            async for delta in stream_reply(build_contents(history, mode, user_text), GEN_CONFIG):
+                text.append(delta)
+                yield f"data: {json_dumps({'delta': delta})}\n\n"
+
+            data = parse_reply("".join(text))
             ai_reply = data.get("ai_reply", "I'm sorry, I didn't catch that.")
             grammar_correction = data.get("grammar_correction")
-
         except Exception as e:
             print(f"Error calling AI: {e}")
             ai_reply = f"I'm having trouble connecting to my brain right now. Error details: {str(e)}"
             grammar_correction = None
-    else:
-        # Mock Response
-        ai_reply = f"[{mode.upper()} MODE] I heard you say: '{user_text}'. (MockAI Mode)"
-        grammar_correction = "Mock feedback: Good effort!" if mode == "interview" else None
+        except BaseException:
+            # The client disconnected mid-stream and the stream is being cancelled, so
+            # nothing more can be awaited here. Still answer the stored user turn so the
+            # history keeps alternating; the partial stream is raw (usually cut-off)
+            # JSON, so never store that as the model's turn.
+            remember_reply_later(session_id, "(The reply was interrupted.)")
+            raise
 
-    # Update history with AI response
-    manage_history(session_id, {"role": "model", "parts": [ai_reply]})
+        await remember_reply(session_id, ai_reply)
 
-    return ChatResponse(
-        ai_reply=ai_reply,
-        grammar_correction=grammar_correction,
-        session_id=session_id
-    )
+        done = {"ai_reply": ai_reply, "grammar_correction": grammar_correction, "session_id": session_id}
+        yield f"event: done\ndata: {json_dumps(done)}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=headers)
+
+# Let browsers reuse frontend assets for a while instead of fetching them on every page load
+STATIC_MAX_AGE = int(os.getenv("STATIC_MAX_AGE", "3600"))
+
+class CachedStaticFiles(StaticFiles):
+    def file_response(self, *args, **kwargs):
+        response = super().file_response(*args, **kwargs)
+        response.headers.setdefault("Cache-Control", f"public, max-age={STATIC_MAX_AGE}")
+        return response
 
 # Mount the frontend directory to serve static files
-from fastapi.staticfiles import StaticFiles
 # Mount to root, so index.html is served at /
 # We use absolute path or relative to main.py
 frontend_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "frontend")
 if os.path.exists(frontend_path):
-    app.mount("/", StaticFiles(directory=frontend_path, html=True), name="frontend")
+    app.mount("/", CachedStaticFiles(directory=frontend_path, html=True), name="frontend")
 else:
     print(f"WARNING: Frontend directory not found at {frontend_path}")
 